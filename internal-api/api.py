@@ -1,39 +1,144 @@
-import os
 import time
+_IMPORT_START = time.perf_counter()  # Measures cold import cost for /ready
+
+import os
+import atexit
+import hashlib
+import secrets
+import signal
+import sys
+import threading
 from flask import Flask, request, jsonify
-from dpop_verify import verify_dpop_proof
+from dpop_verify import verify_dpop_proof, ALG_KEY_TYPES, DEFAULT_ALLOWED_ALGS, UNSUPPORTED_ALG
 from jti_cache import JTICache
+from audit_log import AuditLog
+from jwcrypto import jwk as jwcrypto_jwk, jwt as jwcrypto_jwt
 import jwt
 import requests
 
+IMPORT_MS = (time.perf_counter() - _IMPORT_START) * 1000
+
 app = Flask(__name__)
 jti_cache = JTICache()
 
 KEYCLOAK_URL = os.getenv('KEYCLOAK_URL')
 REALM = os.getenv('REALM', 'agentic-demo')
 
+# Server-side DPoP algorithm allowlist (RFC 9449 negotiation via WWW-Authenticate)
+def _parse_allowed_algs(value):
+    """Parse DPOP_ALLOWED_ALGS, dropping unsupported algs before they are advertised"""
+    algs = []
+    for alg in (a.strip() for a in value.split(',')):
+        if not alg:
+            continue
+        if alg not in ALG_KEY_TYPES:
+            print(f"WARNING: Ignoring unsupported DPoP alg in DPOP_ALLOWED_ALGS: {alg}")
+            continue
+        algs.append(alg)
+    if not algs:
+        raise ValueError(f"DPOP_ALLOWED_ALGS has no supported algs: {value!r}")
+    return tuple(algs)
+
+DPOP_ALLOWED_ALGS = _parse_allowed_algs(
+    os.getenv('DPOP_ALLOWED_ALGS', ','.join(DEFAULT_ALLOWED_ALGS))
+)
+
+def _parse_block_timeout(value):
+    """AUDIT_BLOCK_TIMEOUT_S: seconds to wait in 'block' mode, or 'none' to wait indefinitely"""
+    if value.strip().lower() == 'none':
+        return None
+    return float(value)
+
+audit_log = AuditLog(
+    path=os.getenv('AUDIT_LOG_PATH', 'audit/audit.jsonl'),
+    max_queue=int(os.getenv('AUDIT_QUEUE_SIZE', '10000')),
+    batch_size=int(os.getenv('AUDIT_BATCH_SIZE', '256')),
+    max_bytes=int(os.getenv('AUDIT_MAX_BYTES', str(10 * 1024 * 1024))),
+    backup_count=int(os.getenv('AUDIT_BACKUP_COUNT', '5')),
+    overflow_policy=os.getenv('AUDIT_OVERFLOW_POLICY', 'drop'),
+    block_timeout=_parse_block_timeout(os.getenv('AUDIT_BLOCK_TIMEOUT_S', '0.05'))
+)
+
+# Drain queued audit records on interpreter exit
+atexit.register(audit_log.close)
+
+def _handle_sigterm(signum, frame):
+    """Exit cleanly on `docker stop` (PID 1) so atexit drains the audit queue"""
+    sys.exit(0)
+
+# Parsed RS256 signing keys by kid. The dict is never mutated; refreshes
+# build a new one and swap the reference so readers never see it half-filled.
+signing_keys = {}
+signing_keys_last_refresh = 0  # Time of the last fetch attempt
+signing_keys_loaded_at = 0  # Time of the last successful fetch
+signing_keys_lock = threading.Lock()  # Serializes refreshes
+
+# Minimum seconds between kid-miss refreshes, so random kids can't drive
+# unbounded JWKS fetches against Keycloak
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv('JWKS_MIN_REFRESH_INTERVAL_S', '10'))
+
+# Maximum age of the key cache; after this even known kids force a refetch so
+# keys removed or revoked in Keycloak stop being trusted
+JWKS_CACHE_TTL = float(os.getenv('JWKS_CACHE_TTL_S', '300'))
+
+# Startup warm-up state reported by /ready
+warmup_done = threading.Event()
+warmup_report = {"import_ms": IMPORT_MS}
+
 def get_jwks():
     """Fetch JWKS from Keycloak for token verification"""
     response = requests.get(
-        f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/certs"
+        f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/certs",
+        timeout=5
     )
+    response.raise_for_status()
     return response.json()
 
+def refresh_signing_keys():
+    """Fetch JWKS and swap in a freshly parsed signing key cache"""
+    global signing_keys, signing_keys_last_refresh, signing_keys_loaded_at
+
+    # Count failed fetches too, so a down Keycloak isn't hammered on misses
+    signing_keys_last_refresh = time.time()
+
+    keys = {}
+    for jwk in get_jwks()['keys']:
+        if jwk.get('kty') == 'RSA' and jwk.get('use', 'sig') == 'sig':
+            keys[jwk['kid']] = jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
+
+    signing_keys = keys
+    signing_keys_loaded_at = time.time()
+    return len(keys)
+
+def get_signing_key(kid):
+    """Return the parsed key for kid, refreshing JWKS on a miss or when stale"""
+    if time.time() - signing_keys_loaded_at < JWKS_CACHE_TTL:
+        key = signing_keys.get(kid)
+        if key is not None:
+            return key
+
+    with signing_keys_lock:
+        # Another thread may have refreshed while we waited
+        now = time.time()
+        fresh = now - signing_keys_loaded_at < JWKS_CACHE_TTL
+        key = signing_keys.get(kid)
+        if fresh and key is not None:
+            return key
+        if now - signing_keys_last_refresh < JWKS_MIN_REFRESH_INTERVAL:
+            # Throttled; fail closed rather than trust a stale cache
+            return key if fresh else None
+        refresh_signing_keys()
+        return signing_keys.get(kid)
+
 def verify_access_token(token):
     """Verify OAuth access token"""
     try:
-        jwks = get_jwks()
-
         # Decode token header to get kid
         unverified_header = jwt.get_unverified_header(token)
         kid = unverified_header.get('kid')
 
         # Find matching key
-        key = None
-        for jwk in jwks['keys']:
-            if jwk['kid'] == kid:
-                key = jwt.algorithms.RSAAlgorithm.from_jwk(jwk)
-                break
+        key = get_signing_key(kid)
 
         if not key:
             return None, "Key not found"
@@ -60,14 +165,14 @@ def protected_resource():
     # Extract tokens
     auth_header = request.headers.get('Authorization', '')
     if not auth_header.startswith('Bearer '):
-        print(f"ERROR: Missing authorization header")
+        audit_log.record("deny", reason="Missing authorization")
         return jsonify({"error": "Missing authorization"}), 401
 
     access_token = auth_header[7:]  # Remove "Bearer "
     dpop_proof = request.headers.get('DPoP')
 
     if not dpop_proof:
-        print(f"ERROR: Missing DPoP proof")
+        audit_log.record("deny", reason="Missing DPoP proof")
         return jsonify({"error": "Missing DPoP proof"}), 401
 
     # Verify access token
@@ -76,7 +181,11 @@ def protected_resource():
     token_verify_ms = (time.time() - token_start) * 1000
 
     if error:
-        print(f"ERROR: Token verification failed: {error}")
+        audit_log.record(
+            "deny",
+            reason=f"Token verification failed: {error}",
+            timings={"token_verify_ms": token_verify_ms}
+        )
         return jsonify({"error": f"Invalid token: {error}"}), 403
 
     # Verify DPoP proof
@@ -85,18 +194,43 @@ def protected_resource():
         dpop_proof,
         request.method,
         request.url,
-        access_token
+        access_token,
+        allowed_algs=DPOP_ALLOWED_ALGS
     )
     dpop_verify_ms = (time.time() - dpop_start) * 1000
 
     if not dpop_valid:
-        print(f"ERROR: DPoP verification failed: {dpop_error}")
+        audit_log.record(
+            "deny",
+            reason=f"DPoP verification failed: {dpop_error}",
+            subject=decoded_token.get('sub'),
+            actor=decoded_token.get('act'),
+            timings={
+                "token_verify_ms": token_verify_ms,
+                "dpop_verify_ms": dpop_verify_ms
+            }
+        )
+        if dpop_error == UNSUPPORTED_ALG:
+            # Advertise acceptable algorithms so the client can re-sign
+            return jsonify({"error": f"Invalid DPoP: {dpop_error}"}), 401, {
+                "WWW-Authenticate": f'DPoP algs="{" ".join(DPOP_ALLOWED_ALGS)}"'
+            }
         return jsonify({"error": f"Invalid DPoP: {dpop_error}"}), 403
 
     # Check jti replay
     jti_start = time.time()
     if jti_cache.is_replayed(jti):
-        print(f"ERROR: DPoP replay detected for jti: {jti}")
+        audit_log.record(
+            "deny",
+            reason="DPoP replay detected",
+            subject=decoded_token.get('sub'),
+            actor=decoded_token.get('act'),
+            jti=jti,
+            timings={
+                "token_verify_ms": token_verify_ms,
+                "dpop_verify_ms": dpop_verify_ms
+            }
+        )
         return jsonify({"error": "DPoP replay detected"}), 403
 
     jti_cache.add(jti)
@@ -104,22 +238,130 @@ def protected_resource():
 
     total_verify_ms = (time.time() - start_time) * 1000
 
+    breakdown = {
+        "token_verify_ms": token_verify_ms,
+        "dpop_verify_ms": dpop_verify_ms,
+        "jti_check_ms": jti_check_ms
+    }
+
+    audit_log.record(
+        "allow",
+        subject=decoded_token.get('sub'),
+        actor=decoded_token.get('act'),
+        jti=jti,
+        timings=dict(breakdown, total_verify_ms=total_verify_ms)
+    )
+
     # Return success with metrics
     return jsonify({
         "data": "Success",
         "subject": decoded_token.get('sub'),
         "actor": decoded_token.get('act'),
         "server_verify_ms": total_verify_ms,
-        "breakdown": {
-            "token_verify_ms": token_verify_ms,
-            "dpop_verify_ms": dpop_verify_ms,
-            "jti_check_ms": jti_check_ms
-        }
+        "breakdown": breakdown
     }), 200
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({"status": "healthy"}), 200
+    """Liveness: the process is up (may still be warming up)"""
+    return jsonify({"status": "healthy", "audit": audit_log.stats()}), 200
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness: keys are loaded and verification paths are warm"""
+    if not warmup_done.is_set():
+        return jsonify({"status": "warming_up", **warmup_report}), 503
+    return jsonify({"status": "ready", **warmup_report}), 200
+
+def _warm_rs256():
+    """Sign and verify a throwaway RS256 token to load the PyJWT/RSA paths"""
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    token = jwt.encode({"sub": "warmup", "exp": int(time.time()) + 60},
+                       private_key, algorithm='RS256')
+    jwt.get_unverified_header(token)
+    jwt.decode(token, private_key.public_key(), algorithms=['RS256'],
+               options={"verify_exp": True, "verify_aud": False})
+
+def _warm_dpop(alg):
+    """Build and verify a throwaway DPoP proof for alg via verify_dpop_proof"""
+    kty, crv = ALG_KEY_TYPES[alg]
+    key = jwcrypto_jwk.JWK.generate(kty=kty, crv=crv)
+    access_token = "warmup-access-token"
+    uri = "http://warmup/api/resource"
+
+    proof = jwcrypto_jwt.JWT(
+        header={"typ": "dpop+jwt", "alg": alg,
+                "jwk": key.export_public(as_dict=True)},
+        claims={
+            "jti": secrets.token_urlsafe(16),
+            "htm": "GET",
+            "htu": uri,
+            "iat": int(time.time()),
+            "ath": hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+        }
+    )
+    proof.make_signed_token(key)
+
+    valid, error, _ = verify_dpop_proof(
+        proof.serialize(), "GET", uri, access_token, allowed_algs=(alg,)
+    )
+    if not valid:
+        raise RuntimeError(f"DPoP warm-up failed for {alg}: {error}")
+
+def _warm_up_once():
+    """Single warm-up pass; raises on any failure"""
+    stage = time.perf_counter()
+    with signing_keys_lock:
+        warmup_report["signing_keys"] = refresh_signing_keys()
+    warmup_report["jwks_ms"] = (time.perf_counter() - stage) * 1000
+
+    stage = time.perf_counter()
+    _warm_rs256()
+    warmup_report["rs256_warm_ms"] = (time.perf_counter() - stage) * 1000
+
+    warmup_report["dpop_warm_ms"] = {}
+    for alg in DPOP_ALLOWED_ALGS:
+        stage = time.perf_counter()
+        _warm_dpop(alg)
+        warmup_report["dpop_warm_ms"][alg] = (time.perf_counter() - stage) * 1000
+
+def warm_up(retry_interval=2.0):
+    """Prefetch signing keys and exercise verify paths before reporting ready"""
+    start = time.perf_counter()
+    attempts = 0
+
+    # Keycloak may still be starting; retry until a full pass succeeds and
+    # surface the last error on /ready meanwhile
+    while True:
+        attempts += 1
+        warmup_report["attempts"] = attempts
+        try:
+            _warm_up_once()
+            break
+        except Exception as e:
+            warmup_report["error"] = f"{type(e).__name__}: {e}"
+            print(f"Warm-up attempt {attempts} failed ({e}), retrying...")
+            time.sleep(retry_interval)
+
+    warmup_report.pop("error", None)
+    warmup_report["warmup_ms"] = (time.perf_counter() - start) * 1000
+    warmup_done.set()
+    print(f"Warm-up complete: imports {IMPORT_MS:.1f}ms, "
+          f"warm-up {warmup_report['warmup_ms']:.1f}ms")
+
+_warm_up_thread = None
+
+def start_warm_up():
+    """Start the warm-up thread once, whichever launcher imports the app"""
+    global _warm_up_thread
+    if _warm_up_thread is None:
+        _warm_up_thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+        _warm_up_thread.start()
+
+start_warm_up()
 
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, _handle_sigterm)
     app.run(host='0.0.0.0', port=8000)
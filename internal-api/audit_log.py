@@ -0,0 +1,170 @@
+import json
+import os
+import queue
+import threading
+import time
+
+
+class AuditLog:
+    """Asynchronous, batched audit log for authorization decisions.
+
+    Request handlers call record(), which only enqueues a small dict on a
+    bounded queue. A background writer thread drains the queue in batches
+    and appends newline-delimited JSON to a size-rotated file, so disk I/O
+    never happens on the request path.
+
+    When the queue is full, 'drop' discards the record immediately. 'block'
+    waits up to block_timeout seconds and then drops it (default 0.05s);
+    block_timeout=None waits until space frees up, so no record is lost.
+    """
+
+    def __init__(self, path='audit/audit.jsonl', max_queue=10000,
+                 batch_size=256, flush_interval=0.5,
+                 max_bytes=10 * 1024 * 1024, backup_count=5,
+                 overflow_policy='drop', block_timeout=0.05):
+        if overflow_policy not in ('drop', 'block'):
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout  # Max wait in 'block' mode; None = unbounded
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0  # Records that could not be serialized or written
+        self.lock = threading.Lock()  # Guards the counters
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='audit-writer', daemon=True
+        )
+        self._thread.start()
+
+    def record(self, decision, reason=None, subject=None, actor=None,
+               jti=None, timings=None):
+        """Enqueue an audit record; never performs I/O"""
+        entry = {
+            "ts": time.time(),
+            "decision": decision,
+            "reason": reason,
+            "sub": subject,
+            "act": actor,
+            "jti": jti,
+            "timings": timings or {}
+        }
+
+        try:
+            if self.overflow_policy == 'block':
+                # Bounded by default so a stalled writer can't hang request
+                # threads; None opts into waiting for space (no loss)
+                self.queue.put(entry, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(entry)
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def stats(self):
+        """Return writer counters for monitoring"""
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "writer_alive": self._thread.is_alive()
+            }
+
+    def close(self, timeout=5.0):
+        """Stop the writer after draining any queued records (idempotent)"""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self):
+        """Writer loop: collect a batch, then write it in one call"""
+        while not (self._stop.is_set() and self.queue.empty()):
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            try:
+                self._write(batch)
+            except Exception as e:
+                # Never let an unexpected error kill the writer thread
+                print(f"ERROR: Audit writer error: {e}")
+
+    def _collect_batch(self):
+        """Block for the first record, then take whatever else is ready"""
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        """Append a batch as newline-delimited JSON, rotating by size"""
+        lines = []
+        for entry in batch:
+            # Serialize records individually so one bad record can't sink the batch
+            try:
+                lines.append(json.dumps(entry, separators=(',', ':')) + '\n')
+            except (TypeError, ValueError) as e:
+                with self.lock:
+                    self.failed += 1
+                print(f"ERROR: Unserializable audit record dropped: {e}")
+
+        if not lines:
+            return
+        data = ''.join(lines)
+
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            if self._should_rotate(len(data)):
+                self._rotate()
+
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(data)
+        except OSError as e:
+            with self.lock:
+                self.failed += len(lines)
+            print(f"ERROR: Audit write failed: {e}")
+            return
+
+        with self.lock:
+            self.written += len(lines)
+
+    def _should_rotate(self, incoming):
+        """Rotate when the next batch would push the file past max_bytes"""
+        if self.max_bytes <= 0:
+            return False
+        try:
+            return os.path.getsize(self.path) + incoming > self.max_bytes
+        except OSError:
+            return False
+
+    def _rotate(self):
+        """Shift audit.jsonl -> audit.jsonl.1 -> ... dropping the oldest"""
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
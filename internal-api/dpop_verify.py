@@ -3,7 +3,19 @@ import hashlib
 import time
 from jwcrypto import jwk, jwt
 
-def verify_dpop_proof(dpop_proof, http_method, http_uri, access_token):
+# Supported DPoP signature algorithms and the JWK (kty, crv) each requires
+ALG_KEY_TYPES = {
+    'ES256': ('EC', 'P-256'),
+    'ES384': ('EC', 'P-384'),
+    'EdDSA': ('OKP', 'Ed25519')
+}
+
+DEFAULT_ALLOWED_ALGS = ('ES256', 'EdDSA')
+
+UNSUPPORTED_ALG = "Unsupported alg"
+
+def verify_dpop_proof(dpop_proof, http_method, http_uri, access_token,
+                      allowed_algs=DEFAULT_ALLOWED_ALGS):
     """
     Verify DPoP proof according to RFC 9449
     Returns: (is_valid, error_message, jti)
@@ -24,18 +36,24 @@ def verify_dpop_proof(dpop_proof, http_method, http_uri, access_token):
         if header.get('typ') != 'dpop+jwt':
             return False, "Invalid typ", None
 
-        if header.get('alg') != 'ES256':
-            return False, "Invalid alg", None
+        alg = header.get('alg')
+        if alg not in allowed_algs or alg not in ALG_KEY_TYPES:
+            return False, UNSUPPORTED_ALG, None
 
         if 'jwk' not in header:
             return False, "Missing jwk", None
 
+        # Key type must match the algorithm (no ES256 header with a P-384 key)
+        kty, crv = ALG_KEY_TYPES[alg]
+        if header['jwk'].get('kty') != kty or header['jwk'].get('crv') != crv:
+            return False, "jwk does not match alg", None
+
         # Extract public key from header
         public_key = jwk.JWK(**header['jwk'])
 
         # Verify signature using the JWT token's make_signed_token verification
         # The token is already deserialized, we verify by trying to deserialize again with key
-        verified_token = jwt.JWT(jwt=dpop_proof, key=public_key)
+        verified_token = jwt.JWT(jwt=dpop_proof, key=public_key, algs=[alg])
 
         # Verify claims
         jti = claims.get('jti')
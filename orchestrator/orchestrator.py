@@ -3,11 +3,26 @@ import time
 import hashlib
 import secrets
 from jwcrypto import jwk, jwt
+import re
 import requests
 import json
+from resilience import (
+    CircuitBreaker, CircuitOpenError, RetryBudget, RetryableError,
+    call_with_retry
+)
+
+# Supported DPoP signature algorithms and the key each one signs with
+DPOP_KEY_PARAMS = {
+    'ES256': {'kty': 'EC', 'crv': 'P-256'},
+    'ES384': {'kty': 'EC', 'crv': 'P-384'},
+    'EdDSA': {'kty': 'OKP', 'crv': 'Ed25519'}
+}
+
+# Client preference when negotiating with the server (cheapest first)
+DPOP_ALG_PREFERENCE = ['EdDSA', 'ES256', 'ES384']
 
 class Orchestrator:
-    def __init__(self):
+    def __init__(self, dpop_alg=None):
         self.keycloak_url = os.getenv('KEYCLOAK_URL', 'http://localhost:8080')
         self.api_url = os.getenv('INTERNAL_API_URL')
         self.client_id = os.getenv('CLIENT_ID', 'orchestrator')
@@ -15,24 +30,81 @@ class Orchestrator:
         self.realm = os.getenv('REALM', 'agentic-demo')
 
         # Generate DPoP key pair (persist for session)
-        self.dpop_key = jwk.JWK.generate(kty='EC', crv='P-256')
+        self.dpop_alg = None
+        self.dpop_key = None
+        self.set_dpop_alg(dpop_alg or os.getenv('DPOP_ALG', 'ES256'))
 
         # Token cache
         self.cached_token = None
-        self.token_expiry = 0
+        self.token_expiry = 0  # Refresh deadline (1 min before real expiry)
+        self.token_valid_until = 0  # Actual expiry, used as breaker fallback
+
+        # Resilience around the Keycloak token endpoint
+        self.token_timeout = float(os.getenv('TOKEN_TIMEOUT_S', '2.0'))
+        self.token_max_attempts = int(os.getenv('TOKEN_MAX_ATTEMPTS', '3'))
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5')),
+            reset_timeout=float(os.getenv('BREAKER_RESET_TIMEOUT_S', '10.0'))
+        )
+        self.retry_budget = RetryBudget(
+            ratio=float(os.getenv('RETRY_BUDGET_RATIO', '0.2'))
+        )
+        self.token_retries = 0  # Retries performed by the last token call(s)
+
+        # Artificial IdP latency for experiments (ms added before each call);
+        # set by experiments.py from IDP_INJECTED_DELAY_MS
+        self.idp_delay_ms = 0
+
+    def _token_request(self, data, retry=True):
+        """POST to the token endpoint with timeout, retries and breaker"""
+        def attempt():
+            timeout = self.token_timeout
+            if self.idp_delay_ms:
+                # Injected delay counts against the per-call timeout
+                delay = self.idp_delay_ms / 1000
+                if delay >= timeout:
+                    time.sleep(timeout)
+                    raise RetryableError("Injected IdP delay exceeded timeout")
+                time.sleep(delay)
+                timeout -= delay
+            try:
+                response = requests.post(
+                    f"{self.keycloak_url}/realms/{self.realm}/protocol/openid-connect/token",
+                    data=data,
+                    timeout=timeout
+                )
+            except (requests.Timeout, requests.ConnectionError) as e:
+                raise RetryableError(str(e)) from e
+
+            if response.status_code >= 500 or response.status_code == 429:
+                raise RetryableError(
+                    f"HTTP {response.status_code}: {response.text}"
+                )
+            return response
+
+        try:
+            response, retries = call_with_retry(
+                attempt,
+                self.breaker,
+                self.retry_budget,
+                max_attempts=self.token_max_attempts if retry else 1
+            )
+        except Exception as e:
+            # Count retries made before the call finally failed
+            self.token_retries += getattr(e, 'retries', 0)
+            raise
+        self.token_retries += retries
+        return response
 
-    def get_user_token(self):
+    def get_user_token(self, retry=True):
         """Step 1: Get user access token via OAuth2 client credentials"""
         start = time.time()
 
-        response = requests.post(
-            f"{self.keycloak_url}/realms/{self.realm}/protocol/openid-connect/token",
-            data={
-                "grant_type": "client_credentials",
-                "client_id": self.client_id,
-                "client_secret": self.client_secret
-            }
-        )
+        response = self._token_request({
+            "grant_type": "client_credentials",
+            "client_id": self.client_id,
+            "client_secret": self.client_secret
+        }, retry=retry)
 
         elapsed = (time.time() - start) * 1000
 
@@ -42,22 +114,22 @@ class Orchestrator:
         data = response.json()
         return data['access_token'], elapsed
 
-    def exchange_token(self, user_token):
-        """Step 2: Exchange user token for delegated token (RFC 8693) - REAL IMPLEMENTATION"""
+    def exchange_token(self, user_token, retry=True):
+        """
+        Step 2: Exchange user token for delegated token (RFC 8693) - REAL IMPLEMENTATION
+        Returns: (access_token, elapsed_ms, expires_in_seconds)
+        """
         start = time.time()
 
-        response = requests.post(
-            f"{self.keycloak_url}/realms/{self.realm}/protocol/openid-connect/token",
-            data={
-                "grant_type": "urn:ietf:params:oauth:grant-type:token-exchange",
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-                "subject_token": user_token,
-                "subject_token_type": "urn:ietf:params:oauth:token-type:access_token",
-                "requested_token_type": "urn:ietf:params:oauth:token-type:access_token",
-                "audience": "internal-api"
-            }
-        )
+        response = self._token_request({
+            "grant_type": "urn:ietf:params:oauth:grant-type:token-exchange",
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "subject_token": user_token,
+            "subject_token_type": "urn:ietf:params:oauth:token-type:access_token",
+            "requested_token_type": "urn:ietf:params:oauth:token-type:access_token",
+            "audience": "internal-api"
+        }, retry=retry)
 
         elapsed = (time.time() - start) * 1000
 
@@ -65,7 +137,30 @@ class Orchestrator:
             raise Exception(f"Token exchange failed: {response.text}")
 
         data = response.json()
-        return data['access_token'], elapsed
+        return data['access_token'], elapsed, data.get('expires_in', 300)
+
+    def set_dpop_alg(self, alg):
+        """Switch DPoP algorithm, generating a matching key pair"""
+        if alg not in DPOP_KEY_PARAMS:
+            raise ValueError(f"Unsupported DPoP alg: {alg}")
+        self.dpop_alg = alg
+        self.dpop_key = jwk.JWK.generate(**DPOP_KEY_PARAMS[alg])
+
+    def negotiate_dpop_alg(self, www_authenticate):
+        """
+        Pick a server-accepted alg from a WWW-Authenticate: DPoP algs="..." header
+        Returns True if the algorithm was changed
+        """
+        match = re.search(r'algs="([^"]*)"', www_authenticate or '')
+        if not match:
+            return False
+
+        server_algs = match.group(1).split()
+        for alg in DPOP_ALG_PREFERENCE:
+            if alg in server_algs and alg != self.dpop_alg:
+                self.set_dpop_alg(alg)
+                return True
+        return False
 
     def generate_dpop_proof(self, method, url, access_token):
         """Step 3: Generate DPoP proof (RFC 9449)"""
@@ -77,7 +172,7 @@ class Orchestrator:
         # Create DPoP JWT
         header = {
             "typ": "dpop+jwt",
-            "alg": "ES256",
+            "alg": self.dpop_alg,
             "jwk": json.loads(self.dpop_key.export_public())
         }
 
@@ -123,10 +218,16 @@ class Orchestrator:
             "api_call_ms": 0,
             "server_verify_ms": 0,
             "end_to_end_ms": 0,
-            "status": 0
+            "status": 0,
+            "token_retries": 0,
+            "breaker_state": self.breaker.state,
+            "stale_token_used": False,
+            "dpop_alg": self.dpop_alg,
+            "server_dpop_verify_ms": 0
         }
 
         start_total = time.time()
+        self.token_retries = 0
 
         try:
             # Get/exchange token
@@ -134,13 +235,35 @@ class Orchestrator:
                 access_token = self.cached_token
                 metrics["token_exchange_ms"] = 0  # Using cache
             else:
-                user_token, get_token_time = self.get_user_token()
-                access_token, exchange_time = self.exchange_token(user_token)
-                metrics["token_exchange_ms"] = exchange_time
-
-                # Cache token
-                self.cached_token = access_token
-                self.token_expiry = time.time() + 240  # 4 minutes (5 min token - 1 min buffer)
+                # Expiry is measured from before the request: the token can't
+                # have been issued earlier, so this never overshoots
+                fetch_start = time.time()
+
+                # With a still-valid token to fall back on, make a single
+                # attempt rather than waiting through the retry loop
+                can_fall_back = bool(self.cached_token
+                                     and fetch_start < self.token_valid_until)
+                try:
+                    user_token, get_token_time = self.get_user_token(
+                        retry=not can_fall_back
+                    )
+                    access_token, exchange_time, expires_in = self.exchange_token(
+                        user_token, retry=not can_fall_back
+                    )
+                except (CircuitOpenError, RetryableError):
+                    # Fail fast; keep serving while the cached token is valid
+                    if not (self.cached_token
+                            and time.time() < self.token_valid_until):
+                        raise
+                    access_token = self.cached_token
+                    metrics["stale_token_used"] = True
+                else:
+                    metrics["token_exchange_ms"] = exchange_time
+
+                    # Cache token
+                    self.cached_token = access_token
+                    self.token_valid_until = fetch_start + expires_in
+                    self.token_expiry = self.token_valid_until - 60  # 1 min refresh buffer
 
             # Generate DPoP proof
             dpop_proof, dpop_time = self.generate_dpop_proof(
@@ -153,17 +276,34 @@ class Orchestrator:
             # Call API
             response, api_time = self.call_api(access_token, dpop_proof)
             metrics["api_call_ms"] = api_time
+
+            # Server rejected our alg: switch to one it advertises and retry once
+            if (response.status_code == 401
+                    and self.negotiate_dpop_alg(response.headers.get('WWW-Authenticate'))):
+                dpop_proof, dpop_time = self.generate_dpop_proof(
+                    "GET",
+                    f"{self.api_url}/api/resource",
+                    access_token
+                )
+                metrics["dpop_sign_ms"] += dpop_time
+                response, api_time = self.call_api(access_token, dpop_proof)
+                metrics["api_call_ms"] += api_time
+                metrics["dpop_alg"] = self.dpop_alg
+
             metrics["status"] = response.status_code
 
             # Extract server metrics if available
             if response.status_code == 200:
                 data = response.json()
                 metrics["server_verify_ms"] = data.get("server_verify_ms", 0)
+                metrics["server_dpop_verify_ms"] = data.get("breakdown", {}).get("dpop_verify_ms", 0)
 
         except Exception as e:
             print(f"Request failed: {e}")
-            metrics["status"] = 500
+            metrics["status"] = 503 if isinstance(e, CircuitOpenError) else 500
 
+        metrics["token_retries"] = self.token_retries
+        metrics["breaker_state"] = self.breaker.state
         metrics["end_to_end_ms"] = (time.time() - start_total) * 1000
 
         return metrics
@@ -184,7 +324,7 @@ if __name__ == '__main__':
 
         # Test 2: Exchange token
         print("\n[2/3] Exchanging token (RFC 8693)...")
-        exchanged_token, exchange_ms = orch.exchange_token(subject_token)
+        exchanged_token, exchange_ms, _ = orch.exchange_token(subject_token)
         print(f"✓ Exchanged token: {exchanged_token[:50]}...")
         print(f"✓ Exchange time: {exchange_ms:.2f}ms")
 
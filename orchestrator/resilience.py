@@ -0,0 +1,140 @@
+import random
+import time
+from threading import Lock
+
+
+class CircuitOpenError(Exception):
+    """Raised when the circuit breaker rejects a call without attempting it"""
+
+
+class RetryableError(Exception):
+    """Transient failure (timeout, connection error, 5xx/429) worth retrying"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open probe"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout  # Seconds before a probe is allowed
+        self.failures = 0
+        self.opened_at = 0
+        self._state = self.CLOSED
+        self._probe_in_flight = False
+        self.lock = Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            return self._current_state()
+
+    def allow(self):
+        """Return True if a call may proceed right now"""
+        with self.lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self._state = self.CLOSED
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if (self._probe_in_flight
+                    or self.failures >= self.failure_threshold):
+                self._state = self.OPEN
+                self.opened_at = time.time()
+            self._probe_in_flight = False
+
+    def _current_state(self):
+        """Move OPEN to HALF_OPEN once reset_timeout has elapsed"""
+        if (self._state == self.OPEN
+                and time.time() - self.opened_at >= self.reset_timeout):
+            self._state = self.HALF_OPEN
+        return self._state
+
+
+class RetryBudget:
+    """Global retry budget: retries may not exceed a ratio of calls made.
+
+    Every call deposits `ratio` tokens and every retry spends one, so under
+    sustained failure at most ~ratio extra requests reach the IdP per call.
+    """
+
+    def __init__(self, ratio=0.2, initial_tokens=3, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(initial_tokens)  # Starting balance only
+        self.lock = Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self):
+        """Consume one retry token; False if the budget is exhausted"""
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """Full-jitter exponential backoff for the given retry attempt (1-based)"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
+
+
+def call_with_retry(fn, breaker, budget, max_attempts=3,
+                    base_delay=0.05, max_delay=1.0):
+    """
+    Call fn() behind the breaker, retrying RetryableError with backoff
+    Returns: (result, retries)
+
+    Any exception raised carries the retries already made as `e.retries`.
+    """
+    if not breaker.allow():
+        error = CircuitOpenError("Circuit breaker open")
+        error.retries = 0
+        raise error
+
+    budget.deposit()
+    retries = 0
+
+    while True:
+        try:
+            result = fn()
+        except RetryableError as e:
+            breaker.record_failure()
+            e.retries = retries
+            if retries + 1 >= max_attempts:
+                raise
+            # Check the breaker before spending budget on a retry it would block
+            if not breaker.allow():
+                error = CircuitOpenError("Circuit breaker open")
+                error.retries = retries
+                raise error from e
+            if not budget.try_spend():
+                raise
+            retries += 1
+            time.sleep(backoff_delay(retries, base_delay, max_delay))
+            continue
+        except Exception as e:
+            breaker.record_failure()
+            e.retries = retries
+            raise
+
+        breaker.record_success()
+        return result, retries